@@ -6,22 +6,44 @@ Cache classes that store values in an SQLite3 DB, using SQLAlchemy.
 
 from __future__ import annotations
 
+import json
 import logging
+import pickle
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
-from functools import cached_property
+from functools import partial
+from itertools import chain, islice
+from os import scandir, unlink
 from pathlib import Path
-from threading import RLock
-from typing import TYPE_CHECKING, Union, Optional, Mapping, Iterator, TypeVar, Generic
+from sys import intern
+from threading import Lock, RLock, local
+from typing import TYPE_CHECKING, Any, Callable, Union, Optional, Mapping, Iterable, Iterator, TypeVar, Generic
 
-from sqlalchemy import create_engine, MetaData, Table, Column, PickleType, Integer
+from sqlalchemy import create_engine, event, select, delete, bindparam, literal_column, func
+from sqlalchemy import MetaData, Table, Column, LargeBinary, Integer
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.exc import NoSuchTableError, OperationalError, NoResultFound
+from sqlalchemy.exc import NoSuchTableError, OperationalError
+from sqlalchemy.pool import QueuePool, StaticPool
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from .utils import ScopedSession, validate_or_make_dir, get_user_cache_dir, PathLike
 
 if TYPE_CHECKING:
+    from sqlalchemy.engine import Connection
     from sqlalchemy.orm import scoped_session
+    from sqlalchemy.sql import Select, Insert, Delete
 
 __all__ = ['DBCache', 'DBCacheEntry', 'TTLDBCacheEntry', 'TTLDBCache']
 log = logging.getLogger(__name__)
@@ -34,31 +56,55 @@ DT = TypeVar('DT')
 
 Base = declarative_base()
 _NotSet = object()
+_INSERT_BATCH_SIZE = 10_000
+_YIELD_PER = 1000
+_OPTIMIZE_INTERVAL = 900  # seconds
+_VACUUM_MIN_DELETED = 1000
+_VACUUM_PAGES = 256
+_INTERN_MAX_LEN = 64
+_PATH_CACHE_TTL = 60  # seconds
+_MSGPACK_TUPLE = 1  # msgpack extension type code for tuples in cache keys
+_UNIX_NOW = literal_column("CAST(strftime('%s', 'now') AS INTEGER)")
+# Protocol 5 is also what PickleType used (via HIGHEST_PROTOCOL) on all supported Python versions, so DBs that were
+# created before keys and values were pickled explicitly remain compatible.
+_dumps = partial(pickle.dumps, protocol=5)
+_loads = pickle.loads
 
 
 class DBCacheEntry(Base):
-    """A key, value pair for use in :class:`DBCache`"""
+    """A pickled key, value pair for use in :class:`DBCache`"""
     __tablename__ = 'cache'
 
-    key = Column(PickleType, primary_key=True, index=True, unique=True)
-    value = Column(PickleType)
+    key = Column(LargeBinary, primary_key=True)  # SQLite maintains a unique index for the primary key automatically
+    value = Column(LargeBinary)
 
     def __repr__(self) -> str:
         return f'<{self.__class__.__name__}({self.key!r})>'
 
 
 class TTLDBCacheEntry(Base):
-    """A key, value pair for use in :class:`TTLDBCache`"""
+    """A pickled key, value pair for use in :class:`TTLDBCache`"""
     __tablename__ = 'ttl_cache'
 
-    key = Column(PickleType, primary_key=True, index=True, unique=True)
-    value = Column(PickleType)
-    created = Column(Integer, index=True)
+    key = Column(LargeBinary, primary_key=True)
+    value = Column(LargeBinary)
+    created = Column(Integer, index=True)  # Used by the DELETE in TTLDBCache.expire
 
     def __repr__(self) -> str:
         return f'<{self.__class__.__name__}({self.key!r}, created={self.created})>'
 
 
+class _ThreadState(local):
+    """Per-thread state for a :class:`DBCache`"""
+    # The connection for this thread's active :meth:`DBCache.transaction` or outermost write, which nested operations
+    # must use without committing
+    txn_conn: Optional[Connection] = None
+    # The session returned by :meth:`DBCache.__enter__`, whose connection other operations in this thread must use, or
+    # they would wait for the write lock that it may hold
+    session: Optional[scoped_session] = None
+    session_depth: int = 0
+
+
 class DBCache(Generic[KT, VT]):
     """
     A dictionary-like cache that stores values in an SQLite3 DB.  Old cache files in the cache directory that begin with
@@ -75,7 +121,30 @@ class DBCache(Generic[KT, VT]):
     :param preserve_old: True to preserve old cache files, False (default) to delete them
     :param db_path: An explicit path to use for the DB instead of a dynamically generated one
     :param entry_cls: The class to use for DB entries
+    :param mem_cache_size: The maximum number of rows to keep in the in-memory LRU cache; 0 to disable it
+    :param serializer: The format to use for stored values.  The default (``'pickle'``) supports almost any object,
+      but unpickling a value from a DB file that was written by an untrusted source can execute arbitrary code.
+      ``'msgpack'`` (requires `msgpack <https://pypi.org/project/msgpack/>`_), ``'json'``, and ``'orjson'`` (a faster
+      JSON serializer that requires `orjson <https://pypi.org/project/orjson/>`_) only support basic types like dicts,
+      lists, strings, and numbers - tuples are returned as lists - but they are faster and more compact, and loading
+      them is safe.  Both JSON serializers store non-str dict keys as strings, but ``'orjson'`` stores NaN and infinity
+      as null.  Keys are always pickled.
+
+    The ``key_mode`` class attribute controls the key function returned by :meth:`._get_default_key_func`.  The default
+    (``'hash'``) requires all arguments to be hashable.  Subclasses may set it to ``'msgpack'`` to support unhashable
+    arguments like lists and dicts, which requires `msgpack <https://pypi.org/project/msgpack/>`_.  In that mode, equal
+    dicts produce the same key regardless of their insertion order, and tuples and lists produce different keys.
+
+    The most recently used rows are also kept in an in-memory LRU cache in front of the DB, which is updated or
+    invalidated by writes made through this object.  Values are kept serialized in memory, so every lookup returns a
+    new copy, as it would when reading from the DB.  Writes made by other processes to the same DB file will not be
+    reflected by rows that are already cached in memory.
     """
+    key_mode: str = 'hash'
+    # Maps (prefix, cache_dir, time_fmt) to the DB path that was most recently cleaned up around, and when that happened
+    _path_cache: dict[tuple[str, Path, str], tuple[Path, float]] = {}
+    _path_cache_lock = Lock()
+
     def __init__(
         self,
         prefix: str,
@@ -85,11 +154,35 @@ class DBCache(Generic[KT, VT]):
         preserve_old: bool = False,
         db_path: PathLike = None,
         entry_cls=DBCacheEntry,
+        mem_cache_size: int = 1024,
+        serializer: str = 'pickle',
     ):
+        self._dump_value, self._load_value = _get_serializer(serializer)
         engine_url = self._prep_storage(prefix, cache_dir, cache_subdir, time_fmt, preserve_old, db_path)
         self._entry_cls = entry_cls
-        self.engine = create_engine(engine_url, echo=False)
+        # An in-memory DB only exists for the connection that created it, so all threads must share one connection
+        self._shared_conn = db_path == ':memory:'
+        if self._shared_conn:
+            self.engine = create_engine(
+                engine_url, echo=False, poolclass=StaticPool, connect_args={'check_same_thread': False}
+            )
+        else:
+            # Each thread keeps its own connection checked out (see _get_conn), so overflow must be unlimited,
+            # or threads beyond the pool size + overflow would wait for connections that are never returned
+            self.engine = create_engine(engine_url, echo=False, poolclass=QueuePool, pool_size=5, max_overflow=-1)
+        event.listen(self.engine, 'connect', _set_sqlite_mem_pragmas if self._shared_conn else _set_sqlite_pragmas)
         self._lock = RLock()
+        self._write_depth = 0  # Only modified while holding the exclusive lock
+        self._local = _ThreadState()
+        self._mem: OrderedDict[bytes, tuple[bytes, ...]] = OrderedDict()
+        self._mem_max = mem_cache_size
+        self._mem_lock = Lock()
+        self._mem_gen = 0  # Odd while a write is in progress; incremented when each write starts and ends
+        self._last_optimize = time.monotonic()
+        self.meta = MetaData()
+        self.table = self._load_table()
+        self.db_session = ScopedSession(self.engine)
+        self._prepare_statements()
 
     def _prep_storage(
         self, prefix: str, cache_dir: _Path, cache_subdir: OptStr, time_fmt: str, preserve_old: bool, db_path: _Path
@@ -106,68 +199,339 @@ class DBCache(Generic[KT, VT]):
         else:
             self.cache_dir = get_user_cache_dir(cache_subdir)
 
-        current_db = f'{prefix}.{datetime.now().strftime(time_fmt)}.db'
-        if not preserve_old:
-            self._cleanup_old_dbs(f'{prefix}.', current_db)
+        # Re-creating a cache shortly after another one with the same location was created does not need to repeat the
+        # cleanup scan of the cache dir
+        cache_key = (prefix, self.cache_dir, time_fmt)
+        now = time.monotonic()
+        with self._path_cache_lock:
+            db_path, cleaned_at = self._path_cache.get(cache_key, (None, 0))
+        if db_path is None or now - cleaned_at >= _PATH_CACHE_TTL:
+            current_db = f'{prefix}.{datetime.now().strftime(time_fmt)}.db'
+            db_path = self.cache_dir.joinpath(current_db)
+            if not preserve_old:
+                self._cleanup_old_dbs(f'{prefix}.', current_db)
+                with self._path_cache_lock:
+                    self._path_cache[cache_key] = (db_path, now)
 
-        db_path = self.cache_dir.joinpath(current_db)
         return f'sqlite:///{db_path.as_posix()}'
 
     def _cleanup_old_dbs(self, db_file_prefix: str, current_db: str):
-        for path in self.cache_dir.glob(f'{db_file_prefix}*.db'):
+        # The name of the DB that was current during the last complete cleanup is stored in a hidden marker file, so the
+        # directory only needs to be scanned once for each new DB, instead of once per process
+        marker = self.cache_dir.joinpath(f'.{db_file_prefix}cleanup')
+        try:
+            if marker.read_text('utf-8') == current_db:
+                return
+        except (OSError, UnicodeDecodeError):
+            pass
+
+        failed = False
+        # The file type of each DirEntry is usually known from the directory listing itself, so is_file does not need
+        # an extra stat call
+        with scandir(self.cache_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if name != current_db and name.startswith(db_file_prefix) and name.endswith('.db') and entry.is_file():
+                    try:
+                        unlink(entry.path)
+                    except OSError as e:
+                        failed = True
+                        log.debug('%s while deleting old cache file %s: %s', e.__class__.__name__, entry.path, e)
+                    else:
+                        log.debug('Deleted old cache file: %s', entry.path)
+
+        if not failed:  # Otherwise, the next process should try again
             try:
-                if path.name != current_db and path.is_file():
-                    log.debug(f'Deleting old cache file: {path.as_posix()}')
-                    path.unlink()
+                marker.write_text(current_db, 'utf-8')
             except OSError as e:
-                log.debug(f'{e.__class__.__name__} while deleting old cache file {path.as_posix()}: {e}')
+                log.debug('Unable to write cleanup marker %s: %s', marker, e)
 
-    @cached_property
-    def meta(self) -> MetaData:
-        return MetaData()
-
-    @cached_property
-    def table(self) -> Table:
+    def _load_table(self) -> Table:
+        name = self._entry_cls.__tablename__
         try:
-            return Table(self._entry_cls.__tablename__, self.meta, autoload_with=self.engine)
+            table = Table(name, self.meta, autoload_with=self.engine)
         except NoSuchTableError:
             Base.metadata.create_all(self.engine)
-            return Table(self._entry_cls.__tablename__, self.meta, autoload_with=self.engine)
+            return Table(name, self.meta, autoload_with=self.engine)
 
-    @cached_property
-    def db_session(self) -> ScopedSession:
-        if 'table' not in self.__dict__:
-            _ = self.table  # Populate the cached property
-        return ScopedSession(self.engine)
+        # DBs created by older versions have an additional index on the key that duplicates the primary key's index
+        for index in list(table.indexes):
+            if index.name == f'ix_{name}_key':
+                # Another process may drop it first, and the DB may be read-only or locked; it is only redundant, so a
+                # failure to drop it is not fatal
+                try:
+                    with self.engine.begin() as conn:
+                        conn.exec_driver_sql(f'DROP INDEX IF EXISTS "{index.name}"')
+                except OperationalError as e:
+                    log.debug('Unable to drop redundant index %s: %s', index.name, e)
+                table.indexes.discard(index)
+        return table
+
+    def _select(self, *columns) -> Select:
+        """Base SELECT statement for reading the given columns/expressions from this cache's table"""
+        return select(*columns).select_from(self.table)
+
+    def _delete(self) -> Delete:
+        """Base DELETE statement for removing entries from this cache's table"""
+        return delete(self.table)
+
+    def _get_columns(self) -> tuple[Column, ...]:
+        """The columns that :attr:`._get_stmt` should return for a given key"""
+        return (self.table.c.value,)
+
+    def _prepare_statements(self):
+        table = self.table
+        key_matches = table.c.key == bindparam('key')
+        self._get_stmt: Select = self._select(*self._get_columns()).where(key_matches)
+        # The key is the primary key, so no LIMIT is needed (and it would add 2 bound parameters to the compiled SQL)
+        self._exists_stmt: Select = self._select(literal_column('1')).where(key_matches)
+        self._count_stmt: Select = self._select(func.count())
+        # An UPSERT updates existing rows in place, while INSERT OR REPLACE would delete and re-insert them
+        upsert = sqlite_insert(table)
+        self._set_stmt: Insert = upsert.on_conflict_do_update(
+            index_elements=[table.c.key],
+            set_={col.name: upsert.excluded[col.name] for col in table.c if not col.primary_key},
+        )
+        self._del_stmt: Delete = self._delete().where(key_matches)
+        # Driver-level SQL for the hottest paths, which skips SQLAlchemy's statement cache lookup and parameter
+        # processing.  All of these statements use qmark-style positional parameters, in the order of the table's
+        # columns for inserts, and only the key otherwise.
+        dialect = self.engine.dialect
+        self._get_sql = str(self._get_stmt.compile(dialect=dialect))
+        self._exists_sql = str(self._exists_stmt.compile(dialect=dialect))
+        self._set_sql = str(self._set_stmt.compile(dialect=dialect))
+        self._del_sql = str(self._del_stmt.compile(dialect=dialect))
+        # SQLite supports DELETE ... RETURNING since 3.35; the dialect attribute only exists in SQLAlchemy 2.0+
+        if getattr(dialect, 'delete_returning', False):
+            self._pop_sql = str(self._del_stmt.returning(*self._get_columns()).compile(dialect=dialect))
+        else:
+            self._pop_sql = None
 
     @classmethod
     def _get_default_key_func(cls):
+        if cls.key_mode == 'msgpack':
+            return _CacheKey.msgpack_noself
         return _CacheKey.simple_noself
 
     def __enter__(self) -> scoped_session:
-        self._lock.acquire()
-        return self.db_session.__enter__()
+        self._acquire_write()
+        state = self._local
+        state.session = session = self.db_session.__enter__()
+        state.session_depth += 1
+        return session
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         try:
             self.db_session.__exit__(exc_type, exc_val, exc_tb)
+        finally:
+            state = self._local
+            state.session_depth -= 1
+            if not state.session_depth:
+                state.session = None
+            self._mem.clear()  # The session may have been used to modify any entry
+            self._release_write()
+
+    def _acquire_write(self):
+        """
+        Acquire the exclusive lock.  Reads do not acquire any lock, so while it is held, rows read by other threads are
+        not added to the in-memory cache (see :meth:`._mem_add`).
+        """
+        self._lock.acquire()
+        if not self._write_depth:
+            with self._mem_lock:
+                self._mem_gen += 1
+        self._write_depth += 1
+
+    def _release_write(self):
+        self._write_depth -= 1
+        try:
+            if not self._write_depth:
+                with self._mem_lock:
+                    self._mem_gen += 1
         finally:
             self._lock.release()
 
+    @contextmanager
+    def _write_lock(self) -> Iterator[None]:
+        self._acquire_write()
+        try:
+            yield
+        finally:
+            self._release_write()
+
+    def _mem_get(self, key: bytes) -> bytes:
+        """
+        Retrieve a pickled value from the in-memory LRU cache.  Hits do not acquire any lock - a concurrent eviction
+        results in a KeyError, which is treated as a miss.
+
+        :param key: A pickled key
+        :return: The pickled value
+        :raises: :class:`KeyError` if the key is not in the in-memory cache
+        """
+        row = self._mem[key]
+        self._mem.move_to_end(key)
+        return row[0]
+
+    def _mem_add(self, key: bytes, row: tuple[bytes, ...], gen: int = None):
+        """
+        Add a row, in the form returned by :attr:`._get_stmt`, to the in-memory LRU cache.  Rows are not added while a
+        :meth:`.transaction` is active, since it may still be rolled back.
+
+        :param key: A pickled key
+        :param row: The row for that key
+        :param gen: The value of :attr:`._mem_gen` from before the row was read.  If a write was in progress at that
+          time, or if one started since then, the row may be stale, so it will not be added.  Must only be omitted while
+          holding the exclusive lock.
+        """
+        if self._local.txn_conn is not None or not self._mem_max:
+            return
+        mem = self._mem
+        with self._mem_lock:
+            if gen is not None and (gen & 1 or gen != self._mem_gen):
+                return
+            mem[key] = row
+            if len(mem) > self._mem_max:
+                try:
+                    mem.popitem(last=False)
+                except KeyError:  # Another thread evicted it already
+                    pass
+
+    def _get_conn(self) -> Connection:
+        try:
+            return self._local.conn
+        except AttributeError:
+            self._local.conn = conn = self.engine.connect()
+            return conn
+
+    @contextmanager
+    def _connection(self, write: bool = False) -> Iterator[Connection]:
+        """
+        Provides this thread's persistent Core connection for executing prepared statements without the overhead of an
+        ORM session or a pool checkout.  Any statements executed within this context are committed on exit, or rolled
+        back if an exception is raised.  If a :meth:`.transaction` or another write is active in this thread, then its
+        connection is provided instead, and it is left to the outermost block to commit or roll back.  For example, an
+        iterable passed to :meth:`.update` may read from this cache without committing earlier batches.
+
+        Reads do not acquire any lock - each thread has its own connection, and SQLite isolates readers from writers.
+        The exception is an in-memory DB, where all threads share the same underlying connection, so reads must not
+        overlap with writes.
+
+        While the session returned by :meth:`.__enter__` is active in this thread, its connection is provided instead,
+        and writes commit that session, as they did before Core connections were used.
+
+        :param write: True to hold the exclusive lock, False to read without locking
+        """
+        if (conn := self._local.txn_conn) is not None:  # The outer block already holds the exclusive lock
+            yield conn
+        elif (session := self._local.session) is not None:
+            yield session.connection()
+            if write:
+                session.commit()
+        elif write:
+            with self._write_lock():
+                with self._committing() as conn:
+                    self._local.txn_conn = conn
+                    try:
+                        yield conn
+                    finally:
+                        self._local.txn_conn = None
+                if (now := time.monotonic()) - self._last_optimize >= _OPTIMIZE_INTERVAL:
+                    self._last_optimize = now
+                    self._optimize(conn)
+        elif self._shared_conn:
+            with self._lock, self._committing() as conn:
+                yield conn
+        else:
+            with self._committing() as conn:
+                yield conn
+
+    def _optimize(self, conn: Connection):
+        """
+        Run ``PRAGMA optimize`` in its own transaction, after the triggering write was committed.  It is only a
+        maintenance task, so a failure (such as the DB being busy) is logged instead of being raised from the write.
+        """
+        try:
+            conn.exec_driver_sql('PRAGMA optimize')
+            conn.commit()
+        except OperationalError as e:
+            conn.rollback()
+            log.debug('Error running PRAGMA optimize: %s', e)
+
+    @contextmanager
+    def _committing(self) -> Iterator[Connection]:
+        conn = self._get_conn()
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+
+    def _incremental_vacuum(self):
+        """
+        Return up to :data:`_VACUUM_PAGES` free pages to the file system, if the DB was created with incremental
+        auto_vacuum enabled (otherwise, this is a no-op).  The DBAPI cursor's ``execute`` would only step through the
+        pragma once, freeing a single page, so ``executescript`` is used to run it to completion.
+        """
+        with self._write_lock():
+            self._get_conn().connection.dbapi_connection.executescript(f'PRAGMA incremental_vacuum({_VACUUM_PAGES})')
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """
+        Context manager that wraps all reads and writes made through this cache in the current thread in a single
+        transaction that is committed on exit, or rolled back if an exception is raised.  The exclusive lock is held for
+        the duration of the transaction.  Nested calls join the outermost transaction.
+
+        This is the standard way to store many individual items - each write outside of a transaction is committed (and
+        synced) separately::
+
+            with cache.transaction():
+                for key, value in items:
+                    cache[key] = value
+        """
+        if self._local.txn_conn is not None:
+            yield
+            return
+        if (session := self._local.session) is not None:  # A second connection would wait for the session's lock
+            with self._write_lock():
+                self._local.txn_conn = session.connection()
+                try:
+                    yield
+                except BaseException:
+                    session.rollback()
+                    raise
+                else:
+                    session.commit()
+                finally:
+                    self._local.txn_conn = None
+            return
+        with self._write_lock(), self.engine.begin() as conn:
+            self._local.txn_conn = conn
+            try:
+                yield
+            finally:
+                self._local.txn_conn = None
+
+    def _iter_rows(self, *columns: Column) -> Iterator[tuple[bytes, ...]]:
+        """Stream rows containing only the specified columns, fetching them from the cursor in batches"""
+        with self._connection() as conn:
+            yield from conn.execution_options(yield_per=_YIELD_PER).execute(self._select(*columns))
+
     def keys(self) -> Iterator[KT]:
-        with self as session:
-            for entry in session.query(self._entry_cls):
-                yield entry.key
+        for (key,) in self._iter_rows(self.table.c.key):
+            yield _loads(key)
 
     def values(self) -> Iterator[VT]:
-        with self as session:
-            for entry in session.query(self._entry_cls):
-                yield entry.value
+        load_value = self._load_value
+        for (value,) in self._iter_rows(self.table.c.value):
+            yield load_value(value)
 
     def items(self) -> Iterator[tuple[KT, VT]]:
-        with self as session:
-            for entry in session.query(self._entry_cls):
-                yield entry.key, entry.value
+        load_value = self._load_value
+        for key, value in self._iter_rows(self.table.c.key, self.table.c.value):
+            yield _loads(key), load_value(value)
 
     def get(self, item: KT, default: DT = None) -> Union[VT, DT]:
         try:
@@ -183,7 +547,26 @@ class DBCache(Generic[KT, VT]):
             return default
 
     def pop(self, key: KT, default: DT = _NotSet) -> Union[VT, DT]:
-        with self._lock:
+        if self._pop_sql is None:
+            return self._pop_fallback(key, default)
+
+        pkey = _dumps(key)
+        try:
+            with self._connection(True) as conn:
+                self._mem.pop(pkey, None)
+                row = conn.exec_driver_sql(self._pop_sql, (pkey,)).first()
+        except OperationalError as e:
+            if default is _NotSet:
+                raise KeyError(key) from e
+            return default
+        if row is None or self._is_expired(row):
+            if default is _NotSet:
+                raise KeyError(key)
+            return default
+        return self._load_value(row[0])
+
+    def _pop_fallback(self, key: KT, default: DT = _NotSet) -> Union[VT, DT]:
+        with self._write_lock():
             try:
                 value = self[key]
             except KeyError:
@@ -194,101 +577,276 @@ class DBCache(Generic[KT, VT]):
                 del self[key]
                 return value
 
-    def update(self, data: Mapping[KT, VT]):
-        with self as session:
-            for key, value in data.items():
-                entry = self._entry_cls(key=key, value=value)
-                session.merge(entry)
-            session.commit()
+    def _is_expired(self, row: tuple[bytes, ...]) -> bool:
+        """Whether the given row, in the form returned by :attr:`._get_stmt`, has expired"""
+        return False
+
+    def update(self, data: Union[Mapping[KT, VT], Iterable[tuple[KT, VT]]] = (), /, **kwargs: VT):
+        """Store all of the given items in a single transaction.  Accepts the same arguments as :meth:`dict.update`."""
+        dump_value = self._dump_value
+        self._insert_many((_dumps(key), dump_value(value)) for key, value in _iter_pairs(data, kwargs))
+
+    def _insert_many(self, rows: Iterable[tuple[Any, ...]]):
+        """
+        Insert or replace the given rows in a single transaction, using ``executemany`` for each batch of rows.  Rows
+        must contain values for each column, in order, and keys and values must already be pickled.
+        """
+        rows = iter(rows)
+        with self._connection(True) as conn:
+            while batch := list(islice(rows, _INSERT_BATCH_SIZE)):
+                for row in batch:
+                    self._mem.pop(row[0], None)
+                conn.exec_driver_sql(self._set_sql, batch)
 
     def __iter__(self) -> Iterator[KT]:
         yield from self.keys()
 
     def __len__(self) -> int:
-        with self as session:
-            return session.query(self._entry_cls).count()
+        with self._connection() as conn:
+            return conn.execute(self._count_stmt).scalar()
 
     def __contains__(self, item) -> bool:
-        with self as session:
-            return session.query(self._entry_cls).filter_by(key=item).scalar()
+        key = _dumps(item)
+        try:
+            self._mem_get(key)
+        except KeyError:
+            pass
+        else:
+            return True
+        with self._connection() as conn:
+            return conn.exec_driver_sql(self._exists_sql, (key,)).first() is not None
 
     def __getitem__(self, item: KT) -> VT:
-        with self as session:
-            try:
-                # log.debug('Trying to return {!r}'.format(item))
-                return session.query(self._entry_cls).filter_by(key=item).one().value
-            except (NoResultFound, OperationalError) as e:
-                # log.debug('Did not have cached: {!r}'.format(item))
-                raise KeyError(item) from e
+        key = _dumps(item)
+        try:
+            return self._load_value(self._mem_get(key))
+        except KeyError:
+            pass
+        gen = self._mem_gen
+        try:
+            with self._connection() as conn:
+                if (row := conn.exec_driver_sql(self._get_sql, (key,)).first()) is not None:
+                    self._mem_add(key, tuple(row), gen)
+                    return self._load_value(row[0])
+        except OperationalError as e:
+            raise KeyError(item) from e
+        raise KeyError(item)
 
     def __setitem__(self, key: KT, value: VT):
-        with self as session:
-            entry = self._entry_cls(key=key, value=value)
-            session.merge(entry)
-            session.commit()
+        pkey, pvalue = _dumps(key), self._dump_value(value)
+        with self._write_lock():
+            with self._connection(True) as conn:
+                self._mem.pop(pkey, None)
+                conn.exec_driver_sql(self._set_sql, (pkey, pvalue))
+            self._mem_add(pkey, (pvalue,))  # Only after the commit succeeded
 
     def __delitem__(self, key: KT):
-        with self as session:
-            try:
-                obj = session.query(self._entry_cls).filter_by(key=key).one()
-                # Note: using .delete() instead returns the count of rows deleted, and it never raises NoResultFound
-                session.delete(obj)
-            except (NoResultFound, OperationalError) as e:
-                raise KeyError(key) from e
-            else:
-                session.commit()
+        pkey = _dumps(key)
+        try:
+            with self._connection(True) as conn:
+                self._mem.pop(pkey, None)
+                deleted = conn.exec_driver_sql(self._del_sql, (pkey,)).rowcount
+        except OperationalError as e:
+            raise KeyError(key) from e
+        if not deleted:
+            raise KeyError(key)
 
 
 class TTLDBCache(DBCache[KT, VT]):
     """
+    Expired entries are excluded from all reads, but they are only deleted from the DB at most once per expiration
+    interval, so that most operations do not need to open a write transaction.  When it is due, the deletion happens on
+    the same connection and in the same transaction as the operation that triggered it.
+
     :param ttl: The time to live, in seconds, for entries in this DBCache
+    :param expire_interval: The minimum number of seconds between automatic deletions of expired entries; defaults to
+      1/10 of the TTL, up to 30 seconds
     """
 
-    def __init__(self, *args, ttl: int, **kwargs):
-        super().__init__(*args, entry_cls=TTLDBCacheEntry, **kwargs)
+    def __init__(self, *args, ttl: int, expire_interval: float = None, **kwargs):
         self._ttl = int(ttl)
+        self._expire_interval = min(self._ttl / 10, 30) if expire_interval is None else expire_interval
+        self._last_expire = 0.0
+        super().__init__(*args, entry_cls=TTLDBCacheEntry, **kwargs)
 
     def expire(self, expiration: int = None):
         """
         :param expiration: A unix epoch timestamp - items created before this time will be removed from the cache.
           Defaults to the given TTL seconds earlier than the current time.
         """
-        with self._lock:
-            if expiration is None:
-                expiration = int(time.time()) - self._ttl
-            with self.db_session as session:
-                try:
-                    session.query(self._entry_cls).filter(self._entry_cls.created < expiration).delete()
-                except (NoResultFound, OperationalError):
-                    pass
-                else:
-                    session.commit()
+        if expiration is None:
+            expiration = int(time.time()) - self._ttl
+            self._last_expire = time.monotonic()  # An explicit full expiration resets the automatic interval
+        with super()._connection(True) as conn:
+            deleted = self._expire(conn, expiration)
+        self._maybe_vacuum(deleted)
+
+    def _expire(self, conn: Connection, expiration: int) -> int:
+        """Delete entries created before the given timestamp using the given connection, without committing"""
+        try:
+            deleted = conn.execute(self._expire_stmt, {'expiration': expiration}).rowcount
+        except OperationalError:
+            return 0
+        for key, (_, created) in list(self._mem.items()):
+            if created < expiration:
+                self._mem.pop(key, None)
+        return deleted
+
+    def _expire_due(self) -> bool:
+        if (now := time.monotonic()) - self._last_expire >= self._expire_interval:
+            self._last_expire = now
+            return True
+        return False
+
+    def _maybe_vacuum(self, deleted: int):
+        # The vacuum must run outside of any transaction, so it is skipped if one is active
+        if deleted > _VACUUM_MIN_DELETED and self._local.txn_conn is None:
+            self._incremental_vacuum()
+
+    def _unexpired(self):
+        """SQL condition that is only true for entries that have not expired yet"""
+        return self.table.c.created >= _UNIX_NOW - literal_column(str(self._ttl))
+
+    def _select(self, *columns) -> Select:
+        return super()._select(*columns).where(self._unexpired())
+
+    def _delete(self) -> Delete:
+        # Expired rows that were not removed yet cannot be read, so they must not be found by deletes either
+        return super()._delete().where(self._unexpired())
+
+    def _get_columns(self) -> tuple[Column, ...]:
+        return self.table.c.value, self.table.c.created
+
+    def _prepare_statements(self):
+        super()._prepare_statements()
+        self._expire_stmt: Delete = delete(self.table).where(self.table.c.created < bindparam('expiration'))
+
+    def _is_expired(self, row: tuple[bytes, ...]) -> bool:
+        # Whole seconds, to agree with the SQL filter in :meth:`._unexpired`
+        return row[1] < int(time.time()) - self._ttl
+
+    def _mem_get(self, key: bytes) -> bytes:
+        if self._is_expired(self._mem[key]):
+            self._mem.pop(key, None)
+            raise KeyError(key)
+        return super()._mem_get(key)
 
     def __enter__(self) -> scoped_session:
-        self._lock.acquire()
-        self.expire()
-        return self.db_session.__enter__()
+        with self._write_lock():
+            if self._expire_due():
+                self.expire()
+            return super().__enter__()
+
+    @contextmanager
+    def _connection(self, write: bool = False) -> Iterator[Connection]:
+        if not self._expire_due():
+            with super()._connection(write) as conn:
+                yield conn
+            return
+
+        # The exclusive lock is needed for the DELETE, even if the triggering operation only needs to read
+        with super()._connection(True) as conn:
+            deleted = self._expire(conn, int(time.time()) - self._ttl)
+            yield conn
+        self._maybe_vacuum(deleted)
+
+    def update(self, data: Union[Mapping[KT, VT], Iterable[tuple[KT, VT]]] = (), /, **kwargs: VT):
+        """Store all of the given items in a single transaction.  Accepts the same arguments as :meth:`dict.update`."""
+        self.set_many(_iter_pairs(data, kwargs))
+
+    def set_many(self, pairs: Iterable[tuple[KT, VT]], created: int = None):
+        """
+        Store the given key, value pairs in a single transaction, using the same creation time for all of them.
 
-    def update(self, data: Mapping[KT, VT]):
-        with self as session:
+        :param pairs: An iterable that yields (key, value) tuples
+        :param created: A unix epoch timestamp to use as the creation time for all entries.  Defaults to the current
+          time.
+        """
+        if created is None:
             created = int(time.time())
-            for key, value in data.items():
-                entry = self._entry_cls(key=key, value=value, created=created)
-                session.merge(entry)
-            session.commit()
+        dump_value = self._dump_value
+        self._insert_many((_dumps(key), dump_value(value), created) for key, value in pairs)
 
     def __setitem__(self, key: KT, value: VT):
-        with self as session:
-            entry = self._entry_cls(key=key, value=value, created=int(time.time()))
-            session.merge(entry)
-            session.commit()
+        pkey, pvalue, created = _dumps(key), self._dump_value(value), int(time.time())
+        with self._write_lock():
+            with self._connection(True) as conn:
+                self._mem.pop(pkey, None)
+                conn.exec_driver_sql(self._set_sql, (pkey, pvalue, created))
+            self._mem_add(pkey, (pvalue, created))
+
+
+def _iter_pairs(data: Union[Mapping[KT, VT], Iterable[tuple[KT, VT]]], kwargs: dict[str, VT]) -> Iterator[tuple]:
+    """Yields (key, value) pairs from the given arguments, in the same way that :meth:`dict.update` handles them"""
+    pairs = ((key, data[key]) for key in data.keys()) if hasattr(data, 'keys') else data
+    return chain(pairs, kwargs.items()) if kwargs else iter(pairs)
+
+
+def _get_serializer(name: str) -> tuple[Callable[[Any], bytes], Callable[[bytes], Any]]:
+    """Returns the (dumps, loads) functions for the value serializer with the given name"""
+    if name == 'pickle':
+        return _dumps, _loads
+    elif name == 'msgpack':
+        if msgpack is None:
+            raise RuntimeError('msgpack is required for serializer=msgpack')
+        return partial(msgpack.packb, use_bin_type=True), partial(msgpack.unpackb, raw=False, strict_map_key=False)
+    elif name == 'json':
+        return _json_dumps, json.loads  # json.loads accepts UTF-8 encoded bytes
+    elif name == 'orjson':
+        if orjson is None:
+            raise RuntimeError('orjson is required for serializer=orjson')
+        # Like the json module, convert non-str dict keys to strings instead of raising an exception
+        return partial(orjson.dumps, option=orjson.OPT_NON_STR_KEYS), orjson.loads
+    raise ValueError(f'Invalid serializer={name!r} - expected one of: pickle, msgpack, json, orjson')
+
+
+def _json_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def _set_sqlite_pragmas(dbapi_conn, conn_record):
+    """
+    Configure a new file-backed SQLite connection.  The page size and auto_vacuum mode can only be changed before the
+    first table is created, and they must be set before switching to WAL mode, so they are only set for empty DBs.  WAL
+    mode allows readers to proceed while a write is in progress, and ``synchronous=NORMAL`` is safe in WAL mode (fsync
+    happens at checkpoints instead of on every commit).
+    """
+    cursor = dbapi_conn.cursor()
+    try:
+        if not cursor.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()[0]:
+            cursor.execute('PRAGMA page_size=8192')
+            cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        # Matches pysqlite's default connect timeout, but does not depend on it if other connect args are provided
+        cursor.execute('PRAGMA busy_timeout=5000')
+        _set_common_pragmas(cursor)
+    finally:
+        cursor.close()
+
+
+def _set_sqlite_mem_pragmas(dbapi_conn, conn_record):
+    """Configure a new in-memory SQLite connection, for which journaling / sync settings are not relevant"""
+    cursor = dbapi_conn.cursor()
+    try:
+        _set_common_pragmas(cursor)
+    finally:
+        cursor.close()
+
+
+def _set_common_pragmas(cursor):
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA mmap_size=268435456')  # 256 MiB
+    cursor.execute('PRAGMA cache_size=-65536')  # Negative values = KiB; 64 MiB
 
 
 class _CacheKey:
     __slots__ = ('_hash', '_vals')
 
     def __init__(self, tup):
-        self._vals = tup
+        # Interning short strings makes equality checks against other keys with the same values an identity check.  Long
+        # strings are not interned to avoid unbounded growth of the interned string table.
+        self._vals = tup = tuple(intern(v) if type(v) is str and len(v) <= _INTERN_MAX_LEN else v for v in tup)
         self._hash = hash(tup)
 
     def __hash__(self):
@@ -300,11 +858,60 @@ class _CacheKey:
         except AttributeError:
             return False
 
+    def __reduce__(self):
+        return self._restore, (self._vals,)
+
+    @classmethod
+    def _restore(cls, vals):
+        obj = cls.__new__(cls)
+        obj._vals = vals
+        obj._hash = hash(vals)
+        return obj
+
     @classmethod
     def _to_tuple(cls, *args, **kwargs):
-        return args if not kwargs else args + sum(sorted(kwargs.items()), (cls,))
+        if not kwargs:
+            return args
+        elif len(kwargs) == 1:
+            (key, val), = kwargs.items()
+            return args + (cls, key, val)
+        return args + (cls,) + tuple(kv for item in sorted(kwargs.items()) for kv in item)
 
     @classmethod
     def simple_noself(cls, *args, **kwargs):
         """Return a cache key for the specified hashable arguments, omitting the first positional argument."""
         return cls(cls._to_tuple(*args[1:], **kwargs))
+
+    @classmethod
+    def from_any(cls, *args, **kwargs):
+        """
+        Return a cache key for the specified arguments, which may be unhashable (such as lists or dicts).  The arguments
+        are serialized with msgpack, and the key hashes / compares the resulting bytes.  Dicts are packed with their
+        items in a consistent order, so equal dicts produce equal keys, and tuples are packed differently than lists.
+        """
+        if msgpack is None:
+            raise RuntimeError('msgpack is required for cache keys with unhashable arguments')
+        args = [_canonical(arg) for arg in args]
+        kwargs = [(key, _canonical(val)) for key, val in sorted(kwargs.items())]
+        return cls._restore(msgpack.packb((args, kwargs), use_bin_type=True))
+
+    @classmethod
+    def msgpack_noself(cls, *args, **kwargs):
+        """Return a cache key for the specified msgpack-compatible arguments, omitting the first positional argument."""
+        return cls.from_any(*args[1:], **kwargs)
+
+
+def _canonical(obj):
+    """
+    Convert the given object so that equal values are always packed to the same bytes by msgpack.  Dict items are sorted
+    by their packed keys, since msgpack preserves insertion order, and tuples are wrapped in an extension type, since
+    msgpack would otherwise pack them the same way as lists.
+    """
+    if isinstance(obj, dict):
+        items = ((_canonical(key), _canonical(val)) for key, val in obj.items())
+        return dict(sorted(items, key=lambda kv: msgpack.packb(kv[0], use_bin_type=True)))
+    elif isinstance(obj, tuple):
+        return msgpack.ExtType(_MSGPACK_TUPLE, msgpack.packb([_canonical(val) for val in obj], use_bin_type=True))
+    elif isinstance(obj, list):
+        return [_canonical(val) for val in obj]
+    return obj
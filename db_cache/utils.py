@@ -28,15 +28,21 @@ class ScopedSession:
     :param engine: An `SqlAlchemy Engine
       <http://docs.sqlalchemy.org/en/latest/core/connections.html#sqlalchemy.engine.Engine>`_
     """
-    __slots__ = ('_scoped_session',)
+    __slots__ = ('_scoped_session', '_close')
 
     def __init__(self, engine):
         self._scoped_session = scoped_session(sessionmaker(bind=engine))
+        self._close = self._scoped_session.close  # Bound once to skip the attribute lookup on every exit
 
     def __enter__(self) -> scoped_session:
         return self._scoped_session
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        # Closing releases the connection and discards pending state, but keeps this thread's session for re-use
+        self._close()
+
+    def remove(self):
+        """Close and discard the current thread's session so that a new one will be created on next use"""
         self._scoped_session.remove()
 
 
@@ -17,6 +17,8 @@ optional_dependencies = {
         'pre-commit',
         'ipython',
     ],
+    'msgpack': ['msgpack'],                             # Cache keys with unhashable arguments
+    'orjson': ['orjson'],                               # serializer='orjson' values
 }
 
 setup(
@@ -38,6 +40,6 @@ setup(
         'Programming Language :: Python :: 3.11'
     ],
     python_requires='>=3.8',
-    install_requires=['SQLAlchemy'],
+    install_requires=['SQLAlchemy>=2.0'],
     extras_require=optional_dependencies,
 )
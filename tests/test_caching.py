@@ -1,13 +1,29 @@
 #!/usr/bin/env python
 
+from __future__ import annotations
+
+import pickle
 import time
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from unittest import TestCase, main
+from threading import Barrier, Thread, Event
+from unittest import TestCase, main, skipIf
 from unittest.mock import Mock, patch
 
-from db_cache.caches import TTLDBCache, DBCache, _CacheKey
-from db_cache.utils import validate_or_make_dir
+from sqlalchemy import event
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from db_cache.caches import TTLDBCache, DBCache, _CacheKey, _dumps, _get_serializer, msgpack, orjson
+from db_cache.utils import ScopedSession, validate_or_make_dir
+
+
+def _capture_sql(engine) -> list[str]:
+    """Returns a list that the SQL of every statement executed by the given engine will be appended to"""
+    statements = []
+    event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    return statements
 
 
 class TTLDBCacheTest(TestCase):
@@ -26,19 +42,66 @@ class TTLDBCacheTest(TestCase):
         self.assertIs(None, cache.cache_dir)
         self.assertEqual('sqlite:///:memory:', str(cache.engine.url))
 
-    def test_db_session_skips_table_call(self):  # noqa
-        with patch('db_cache.caches.Table') as table_mock:
-            cache = DBCache('test', db_path=':memory:')
-            cache.__dict__['table'] = Mock()
-            _ = cache.db_session
-            table_mock.assert_not_called()
+    def test_table_created_on_init(self):
+        for cache_cls, kwargs in ((DBCache, {}), (TTLDBCache, {'ttl': 100})):
+            with self.subTest(cache_cls=cache_cls):
+                cache = cache_cls('test', db_path=':memory:', **kwargs)
+                self.assertEqual(cache._entry_cls.__tablename__, cache.table.name)
+                self.assertIsInstance(cache.db_session, ScopedSession)
+                # The driver-level SQL relies on positional parameters being in column order
+                expected = ['key', 'value', 'created'] if kwargs else ['key', 'value']
+                self.assertEqual(expected, cache._set_stmt.compile(dialect=cache.engine.dialect).positiontup)
+                self.assertIn('ON CONFLICT ("key") DO UPDATE', cache._set_sql)
+                for name in ('_get_stmt', '_exists_stmt', '_del_stmt'):
+                    stmt = getattr(cache, name)
+                    self.assertEqual(['key'], stmt.compile(dialect=cache.engine.dialect).positiontup)
+                if kwargs:
+                    expire_stmt = cache._expire_stmt.compile(dialect=cache.engine.dialect)
+                    self.assertEqual(['expiration'], expire_stmt.positiontup)
+
+    def test_indexes(self):
+        index_query = "SELECT name FROM sqlite_master WHERE tbl_name = 'ttl_cache' AND type = 'index'"
+        with TemporaryDirectory() as tmp_dir:
+            db_path = Path(tmp_dir, 'test.db')
+            cache = TTLDBCache('test', ttl=100, db_path=db_path)
+            with cache._connection() as conn:
+                indexes = conn.exec_driver_sql(index_query).scalars().all()
+                plan = conn.exec_driver_sql('EXPLAIN QUERY PLAN DELETE FROM ttl_cache WHERE created < 1').all()
+                # Simulate a DB that was created with the redundant index on the key
+                conn.exec_driver_sql('CREATE UNIQUE INDEX ix_ttl_cache_key ON ttl_cache ("key")')
+            self.assertEqual({'sqlite_autoindex_ttl_cache_1', 'ix_ttl_cache_created'}, set(indexes))
+            self.assertIn('USING INDEX ix_ttl_cache_created', plan[0][-1])
+            cache.engine.dispose()
+
+            cache = TTLDBCache('test', ttl=100, db_path=db_path)
+            with cache._connection() as conn:
+                indexes = conn.exec_driver_sql(index_query).scalars().all()
+            self.assertNotIn('ix_ttl_cache_key', indexes)
+            self.assertEqual({'ix_ttl_cache_created'}, {index.name for index in cache.table.indexes})
+            with cache._connection(True) as conn:
+                conn.exec_driver_sql('CREATE UNIQUE INDEX ix_ttl_cache_key ON ttl_cache ("key")')
+            cache.engine.dispose()
+
+            exec_driver_sql = Connection.exec_driver_sql
+
+            def fail_drop(conn, statement, *args, **kwargs):
+                if statement.startswith('DROP'):
+                    raise OperationalError(statement, (), Exception('database is locked'))
+                return exec_driver_sql(conn, statement, *args, **kwargs)
+
+            # Failing to drop it (e.g., a read-only or locked DB) should not prevent the cache from being used
+            with patch.object(Connection, 'exec_driver_sql', fail_drop):
+                with self.assertLogs('db_cache.caches', 'DEBUG') as log_ctx:
+                    cache = TTLDBCache('test', ttl=100, db_path=db_path)
+            self.assertTrue(any('Unable to drop redundant index' in line for line in log_ctx.output))
+            self.assertEqual({'ix_ttl_cache_created'}, {index.name for index in cache.table.indexes})
+            cache.engine.dispose()
 
     def test_error_on_clean_old(self):
         with TemporaryDirectory() as tmp_dir:
             cache = DBCache('test', cache_dir=tmp_dir)
-            path_mock = Mock(is_file=Mock(side_effect=OSError))
-            path_mock.name = 'foo'
-            with patch.object(Path, 'glob', return_value=[path_mock]):
+            Path(tmp_dir, 'foo.db').touch()
+            with patch('db_cache.caches.unlink', side_effect=OSError):
                 with self.assertLogs('db_cache.caches', 'DEBUG') as log_ctx:
                     cache._cleanup_old_dbs('foo', 'bar')
                 self.assertTrue(any('while deleting old cache file' in line for line in log_ctx.output))
@@ -52,12 +115,48 @@ class TTLDBCacheTest(TestCase):
             old_path.touch()
             non_db_path = tmp_dir.joinpath('test.foo.txt')
             non_db_path.touch()
+            other_prefix_path = tmp_dir.joinpath('tester.old.db')
+            other_prefix_path.touch()
             DBCache('test', cache_dir=tmp_dir, preserve_old=True)
             self.assertTrue(old_path.exists())
             DBCache('test', cache_dir=tmp_dir)
             self.assertFalse(old_path.exists())
             self.assertTrue(non_db_path.exists())
             self.assertTrue(sub_dir.exists())
+            self.assertTrue(other_prefix_path.exists())
+
+    def test_cleanup_marker(self):
+        with TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir)
+            cache = DBCache('test', cache_dir=tmp_dir, preserve_old=True)
+            marker = tmp_dir.joinpath('.test.cleanup')
+            self.assertFalse(marker.exists())
+            cache._cleanup_old_dbs('test.', 'test.new.db')
+            self.assertEqual('test.new.db', marker.read_text('utf-8'))
+
+            old_path = tmp_dir.joinpath('test.old.db')
+            old_path.touch()
+            cache._cleanup_old_dbs('test.', 'test.new.db')
+            self.assertTrue(old_path.exists())  # The scan was skipped since the current DB did not change
+            with patch('db_cache.caches.unlink', side_effect=OSError):
+                cache._cleanup_old_dbs('test.', 'test.newer.db')
+            self.assertEqual('test.new.db', marker.read_text('utf-8'))  # Not updated after a failure
+            cache._cleanup_old_dbs('test.', 'test.newer.db')
+            self.assertFalse(old_path.exists())
+            self.assertEqual('test.newer.db', marker.read_text('utf-8'))
+
+    def test_repeated_init_skips_cleanup(self):
+        with TemporaryDirectory() as tmp_dir:
+            with patch.object(DBCache, '_cleanup_old_dbs') as cleanup_mock:
+                a = DBCache('test', cache_dir=tmp_dir)
+                b = DBCache('test', cache_dir=tmp_dir)
+                cleanup_mock.assert_called_once()
+                self.assertEqual(a.engine.url, b.engine.url)
+                with patch('db_cache.caches._PATH_CACHE_TTL', 0):
+                    DBCache('test', cache_dir=tmp_dir)
+                self.assertEqual(2, cleanup_mock.call_count)
+                DBCache('other', cache_dir=tmp_dir)
+                self.assertEqual(3, cleanup_mock.call_count)
 
     def test_db_path_dir_created(self):
         with TemporaryDirectory() as tmp_dir:
@@ -85,14 +184,119 @@ class TTLDBCacheTest(TestCase):
                 self.assertEqual({'a', 'b'}, set(cache.keys()))
                 self.assertEqual({1, 2}, set(cache.values()))
 
+    def test_update_batches_and_replaces(self):
+        for cache in (DBCache('test', db_path=':memory:'), TTLDBCache('test', ttl=100, db_path=':memory:')):
+            with self.subTest(cache=cache), patch('db_cache.caches._INSERT_BATCH_SIZE', 2):
+                cache[('a', 1)] = 0
+                cache.update({('a', 1): 1, 'b': [2], 'c': 3, 'd': 4, 'e': 5})
+                self.assertEqual(5, len(cache))
+                self.assertEqual(1, cache[('a', 1)])
+                self.assertEqual([2], cache['b'])
+                self.assertEqual(5, cache['e'])
+                with patch('db_cache.caches._YIELD_PER', 2):
+                    self.assertEqual({('a', 1): 1, 'b': [2], 'c': 3, 'd': 4, 'e': 5}, dict(cache.items()))
+                    self.assertEqual({('a', 1), 'b', 'c', 'd', 'e'}, set(cache.keys()))
+
+    def test_update_dict_args(self):
+        for cache in (DBCache('test', db_path=':memory:'), TTLDBCache('test', ttl=100, db_path=':memory:')):
+            with self.subTest(cache=cache.__class__.__name__):
+                with patch.object(cache, '_insert_many', wraps=cache._insert_many) as insert_mock:
+                    cache.update([('a', 1), ('b', 2)], c=3)
+                    cache.update(d=4)
+                    cache.update()
+                self.assertEqual(3, insert_mock.call_count)
+                self.assertEqual({'a': 1, 'b': 2, 'c': 3, 'd': 4}, dict(cache.items()))
+
+    def test_len_count_query(self):
+        cache = TTLDBCache('test', ttl=100, db_path=':memory:')
+        cache.update(a=1, b=2)
+        statements = _capture_sql(cache.engine)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, len(statements))
+        self.assertTrue(statements[0].startswith('SELECT count(*)'))
+        self.assertEqual(1, statements[0].count('SELECT'))  # No subquery
+
+    def test_iteration_selects_needed_columns(self):
+        cache = DBCache('test', db_path=':memory:')
+        cache.update(a=1, b=2)
+        statements = _capture_sql(cache.engine)
+        expected = {'keys': ['a', 'b'], 'values': [1, 2], 'items': [('a', 1), ('b', 2)]}
+        for method, columns in (('keys', 'key'), ('values', 'value'), ('items', 'key, value')):
+            with self.subTest(method=method):
+                self.assertEqual(expected[method], sorted(getattr(cache, method)()))
+                select_clause = ' '.join(statements[-1].replace('"', '').split()).split(' FROM ')[0]
+                self.assertEqual(f'SELECT {columns}', select_clause.replace(f'{cache.table.name}.', ''))
+
+    def test_hot_paths_not_compiled(self):
+        cache = DBCache('test', db_path=':memory:', mem_cache_size=0)
+        compiler = Mock(side_effect=AssertionError('Statements should be pre-compiled'))
+        with patch.object(cache.engine.dialect, 'statement_compiler', compiler):
+            cache['a'] = 1
+            self.assertEqual(1, cache['a'])
+            self.assertIn('a', cache)
+            del cache['a']
+            self.assertNotIn('a', cache)
+
+    def test_contains_does_not_load_value(self):
+        cache = DBCache('test', db_path=':memory:', mem_cache_size=0)
+        cache['a'] = 1
+        statements = _capture_sql(cache.engine)
+        with patch.object(cache, '_load_value', side_effect=AssertionError('The value should not be loaded')):
+            self.assertIn('a', cache)
+            self.assertNotIn('b', cache)
+        self.assertEqual(2, len(statements))
+        self.assertTrue(all(stmt.startswith('SELECT 1 ') for stmt in statements))
+
+    def test_raw_protocol_5_storage(self):
+        cache = DBCache('test', db_path=':memory:')
+        cache['a'] = {'b': 1}
+        with cache._connection() as conn:
+            key, value = conn.exec_driver_sql(f'SELECT key, value FROM {cache.table.name}').one()
+        self.assertIsInstance(key, bytes)
+        self.assertEqual(b'\x80\x05', value[:2])  # PROTO opcode + protocol number
+        self.assertEqual('a', pickle.loads(key))
+        self.assertEqual({'b': 1}, pickle.loads(value))
+
+    def test_serializers(self):
+        value = {'a': [1, 2.5, None, True], 'b': {'c': 'd'}}
+        for serializer in ('pickle', 'msgpack', 'json', 'orjson'):
+            if (serializer == 'msgpack' and msgpack is None) or (serializer == 'orjson' and orjson is None):
+                continue
+            with self.subTest(serializer=serializer):
+                cache = TTLDBCache('test', ttl=100, db_path=':memory:', serializer=serializer, mem_cache_size=0)
+                cache[('x', 1)] = value
+                cache.update(y=[1])
+                self.assertEqual(value, cache[('x', 1)])
+                self.assertEqual({('x', 1): value, 'y': [1]}, dict(cache.items()))
+                self.assertEqual(value, cache.pop(('x', 1)))
+                cache['z'] = {1: 'a'}
+                expected = {'1': 'a'} if 'json' in serializer else {1: 'a'}
+                self.assertEqual(expected, cache['z'])
+
+    def test_json_serializers_match(self):
+        dumps, loads = _get_serializer('json')
+        self.assertEqual(b'{"a":[1,"b"],"1":2}', dumps({'a': [1, 'b'], 1: 2}))
+        self.assertEqual({'a': [1, 'b']}, loads(b'{"a":[1,"b"]}'))
+        if orjson is not None:
+            orjson_dumps, orjson_loads = _get_serializer('orjson')
+            self.assertEqual(dumps({'a': [1, 'b'], 1: 2}), orjson_dumps({'a': [1, 'b'], 1: 2}))
+
+    def test_invalid_serializer(self):
+        with self.assertRaises(ValueError):
+            DBCache('test', db_path=':memory:', serializer='yaml')
+        with patch('db_cache.caches.msgpack', None), self.assertRaises(RuntimeError):
+            DBCache('test', db_path=':memory:', serializer='msgpack')
+        with patch('db_cache.caches.orjson', None), self.assertRaises(RuntimeError):
+            DBCache('test', db_path=':memory:', serializer='orjson')
+
     def test_entry_expiry(self):
         db = TTLDBCache('test', ttl=100, db_path=':memory:')
         db['a'] = 'test a'
         db['b'] = 'test b'
         with db.db_session as session:
-            entry = db._entry_cls(key='c', value='test c', created=int(time.time() - 50))
+            entry = db._entry_cls(key=_dumps('c'), value=_dumps('test c'), created=int(time.time() - 50))
             session.merge(entry)
-            entry = db._entry_cls(key='d', value='test d', created=int(time.time() - 200))
+            entry = db._entry_cls(key=_dumps('d'), value=_dumps('test d'), created=int(time.time() - 200))
             session.merge(entry)
             session.commit()
 
@@ -109,6 +313,327 @@ class TTLDBCacheTest(TestCase):
         self.assertNotIn('c', db)
         self.assertNotIn('d', db)
 
+    def test_memory_lru(self):
+        cache = DBCache('test', db_path=':memory:', mem_cache_size=2)
+        cache['a'] = [1]
+        cache['b'] = 2
+        with patch.object(cache, '_connection', side_effect=AssertionError('DB should not be used')):
+            value = cache['a']
+            self.assertEqual([1], value)
+            value.append(2)
+            self.assertEqual([1], cache['a'])  # A copy is returned for every lookup
+            self.assertIn('b', cache)
+        cache['c'] = 3
+        self.assertEqual([_dumps('b'), _dumps('c')], list(cache._mem))  # a was least recently used after b was checked
+        self.assertEqual([1], cache['a'])
+        self.assertEqual([_dumps('c'), _dumps('a')], list(cache._mem))
+        del cache['a']
+        self.assertNotIn(_dumps('a'), cache._mem)
+        cache.update({'c': 4})
+        self.assertEqual([], list(cache._mem))
+        self.assertEqual(4, cache['c'])
+        with cache:
+            pass
+        self.assertEqual([], list(cache._mem))
+
+    def test_memory_lru_disabled(self):
+        cache = DBCache('test', db_path=':memory:', mem_cache_size=0)
+        cache['a'] = 1
+        self.assertEqual(1, cache['a'])
+        self.assertEqual(0, len(cache._mem))
+
+    def test_memory_lru_ttl(self):
+        db = TTLDBCache('test', ttl=100, db_path=':memory:')
+        db['a'] = 1
+        db['b'] = 2
+        db._mem[_dumps('a')] = (_dumps(1), int(time.time() - 200))
+        with self.assertRaises(KeyError):
+            db._mem_get(_dumps('a'))
+        self.assertNotIn(_dumps('a'), db._mem)
+        db._mem[_dumps('b')] = (_dumps(2), int(time.time() - 50))
+        db.expire(int(time.time() - 49))
+        self.assertEqual({}, db._mem)
+
+    def test_transaction(self):
+        with TemporaryDirectory() as tmp_dir:
+            for cache_cls, kwargs in ((DBCache, {}), (TTLDBCache, {'ttl': 100})):
+                with self.subTest(cache_cls=cache_cls):
+                    cache = cache_cls('test', db_path=Path(tmp_dir).joinpath(f'{cache_cls.__name__}.db'), **kwargs)
+                    cache['a'] = 0
+                    with cache.transaction():
+                        cache['a'] = 1
+                        cache['b'] = 2
+                        with cache.transaction():
+                            del cache['b']
+                            cache['c'] = 3
+                        self.assertEqual(1, cache['a'])
+                        self.assertEqual({'a', 'c'}, set(cache))
+                        self.assertEqual({}, cache._mem)
+                        with cache.engine.connect() as conn:  # Other connections should not see uncommitted changes
+                            self.assertEqual(1, conn.execute(cache._count_stmt).scalar())
+                    self.assertEqual({'a': 1, 'c': 3}, dict(cache.items()))
+
+                    with self.assertRaises(ValueError):
+                        with cache.transaction():
+                            cache['a'] = 4
+                            cache['d'] = 5
+                            raise ValueError
+                    self.assertEqual({'a': 1, 'c': 3}, dict(cache.items()))
+                    self.assertEqual(1, cache['a'])
+                    cache.engine.dispose()
+
+    def test_writes_in_session_context(self):
+        with TemporaryDirectory() as tmp_dir:
+            for cache_cls, kwargs in ((DBCache, {}), (TTLDBCache, {'ttl': 100})):
+                with self.subTest(cache_cls=cache_cls):
+                    cache = cache_cls('test', db_path=Path(tmp_dir).joinpath(f'{cache_cls.__name__}.db'), **kwargs)
+                    entry_kwargs = {'created': int(time.time())} if kwargs else {}
+                    with cache as session:
+                        session.merge(cache._entry_cls(key=_dumps('x'), value=_dumps(1), **entry_kwargs))
+                        session.flush()  # Holds SQLite's write lock until the session is committed
+                        cache['y'] = 2
+                        with cache.transaction():
+                            cache['z'] = 3
+                        self.assertEqual(2, cache.pop('y'))
+                        session.commit()
+                    self.assertEqual({'x': 1, 'z': 3}, dict(cache.items()))
+                    self.assertIsNone(cache._local.session)
+                    cache.engine.dispose()
+
+    def test_delete_single_statement(self):
+        for cache in (DBCache('test', db_path=':memory:'), TTLDBCache('test', ttl=100, db_path=':memory:')):
+            with self.subTest(cache=cache):
+                cache['a'] = 1
+                _ = len(cache)  # Trigger any pending TTL expiration before counting statements
+                statements = _capture_sql(cache.engine)
+                del cache['a']
+                with self.assertRaises(KeyError):
+                    del cache['a']
+                self.assertEqual(2, len(statements))
+                self.assertTrue(all(stmt.startswith('DELETE') for stmt in statements))
+
+        db = TTLDBCache('test', ttl=100, db_path=':memory:')
+        db.set_many([('a', 1)], created=int(time.time()) - 200)
+        db._last_expire = time.monotonic()  # The expired row must not be found even if it was not removed yet
+        self.assertNotIn('a', db)
+        with self.assertRaises(KeyError):
+            del db['a']
+
+    def test_pop_single_statement(self):
+        for cache in (DBCache('test', db_path=':memory:'), TTLDBCache('test', ttl=100, db_path=':memory:')):
+            with self.subTest(cache=cache.__class__.__name__):
+                cache._last_expire = time.monotonic()
+                cache.update(a=1, b=2)
+                statements = _capture_sql(cache.engine)
+                self.assertEqual(1, cache.pop('a'))
+                self.assertEqual(1, len(statements))
+                self.assertTrue(statements[0].startswith('DELETE') and 'RETURNING' in statements[0])
+                self.assertNotIn('a', cache)
+                self.assertIsNone(cache.pop('a', None))
+                with self.assertRaises(KeyError):
+                    cache.pop('a')
+                cache._pop_sql = None  # The fallback for DBs that do not support DELETE ... RETURNING
+                self.assertEqual(2, cache.pop('b'))
+                self.assertEqual(0, len(cache))
+
+    def test_pop_expired(self):
+        db = TTLDBCache('test', ttl=100, db_path=':memory:')
+        db.set_many([('a', 1)], created=int(time.time()) - 200)
+        self.assertEqual('x', db.pop('a', 'x'))
+        with self.assertRaises(KeyError):
+            db.pop('a')
+
+    def test_expiry_uses_whole_seconds(self):
+        db = TTLDBCache('test', ttl=100, db_path=':memory:')
+        now = int(time.time())
+        # Rows created exactly ttl seconds ago are still returned by SQL, so they must not be treated as expired
+        with patch('db_cache.caches.time.time', return_value=now + 0.5):
+            self.assertFalse(db._is_expired((b'', now - 100)))
+            self.assertTrue(db._is_expired((b'', now - 101)))
+
+    def test_thread_local_connection(self):
+        cache = DBCache('test', db_path=':memory:')
+        conn = cache._get_conn()
+        self.assertIs(conn, cache._get_conn())
+        other = []
+        thread = Thread(target=lambda: other.append(cache._get_conn()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(conn, other[0])
+
+    def test_reads_not_blocked_by_writer(self):
+        with TemporaryDirectory() as tmp_dir:
+            cache = DBCache('test', db_path=Path(tmp_dir, 'test.db'))
+            cache['a'] = 1
+            cache._mem.clear()
+            in_txn, done = Event(), Event()
+
+            def write():
+                with cache.transaction():
+                    cache['a'] = 2
+                    in_txn.set()
+                    done.wait(5)
+
+            thread = Thread(target=write)
+            thread.start()
+            try:
+                self.assertTrue(in_txn.wait(5))
+                self.assertEqual(1, cache['a'])  # The uncommitted value is not visible, and the read did not block
+                self.assertNotIn(_dumps('a'), cache._mem)  # Rows read during a write are not cached
+            finally:
+                done.set()
+                thread.join()
+            self.assertEqual(2, cache['a'])
+            cache.engine.dispose()
+
+    def test_stale_read_not_cached(self):
+        cache = DBCache('test', db_path=':memory:')
+        gen = cache._mem_gen
+        with cache._write_lock():
+            self.assertEqual(gen + 1, cache._mem_gen)
+            cache._mem_add(_dumps('a'), (_dumps(1),), gen + 1)
+        cache._mem_add(_dumps('b'), (_dumps(2),), gen)
+        self.assertEqual(gen + 2, cache._mem_gen)
+        self.assertEqual({}, cache._mem)
+
+    def test_memory_db_shared_between_threads(self):
+        cache = DBCache('test', db_path=':memory:', mem_cache_size=0)
+        self.assertIsInstance(cache.engine.pool, StaticPool)
+        cache['a'] = 1
+        results = []
+
+        def read_and_write():
+            results.append(cache['a'])
+            cache['b'] = 2
+
+        thread = Thread(target=read_and_write)
+        thread.start()
+        thread.join()
+        self.assertEqual([1], results)
+        self.assertEqual(2, cache['b'])
+
+    def test_file_db_pool(self):
+        with TemporaryDirectory() as tmp_dir:
+            cache = DBCache('test', db_path=Path(tmp_dir, 'test.db'))
+            self.assertIsInstance(cache.engine.pool, QueuePool)
+            # More threads than pool_size + the default max_overflow, which all keep their connections at the same time
+            barrier = Barrier(20, timeout=5)
+
+            def write(i):
+                cache[i] = i
+                barrier.wait()
+
+            threads = [Thread(target=write, args=(i,)) for i in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertFalse(barrier.broken)
+            self.assertEqual(20, len(cache))
+            cache.engine.dispose()
+
+    def test_failed_write_rolled_back(self):
+        cache = DBCache('test', db_path=':memory:')
+        with self.assertRaises(ValueError):
+            with cache._connection(True) as conn:
+                conn.execute(cache._set_stmt, {'key': _dumps('a'), 'value': _dumps(1)})
+                raise ValueError
+        self.assertNotIn('a', cache)
+
+    def test_nested_read_does_not_commit_update(self):
+        cache = DBCache('test', db_path=':memory:', mem_cache_size=0)
+        cache.update((i, 0) for i in range(6))
+
+        def incremented():
+            for i in range(6):
+                if i == 4:
+                    raise ValueError
+                yield i, cache[i] + 1
+
+        with patch('db_cache.caches._INSERT_BATCH_SIZE', 2), self.assertRaises(ValueError):
+            cache.update(incremented())
+        self.assertEqual({i: 0 for i in range(6)}, dict(cache.items()))
+        self.assertFalse(cache._get_conn().in_transaction())
+
+    def test_file_db_pragmas(self):
+        with TemporaryDirectory() as tmp_dir:
+            cache = DBCache('test', db_path=Path(tmp_dir).joinpath('test.db'))
+            with cache.engine.connect() as conn:
+                self.assertEqual('wal', conn.exec_driver_sql('PRAGMA journal_mode').scalar())
+                self.assertEqual(1, conn.exec_driver_sql('PRAGMA synchronous').scalar())  # 1 = NORMAL
+                self.assertEqual(8192, conn.exec_driver_sql('PRAGMA page_size').scalar())
+                self.assertEqual(2, conn.exec_driver_sql('PRAGMA auto_vacuum').scalar())  # 2 = INCREMENTAL
+                self.assertEqual(5000, conn.exec_driver_sql('PRAGMA busy_timeout').scalar())
+            cache.engine.dispose()
+
+    def test_memory_db_pragmas(self):
+        cache = DBCache('test', db_path=':memory:')
+        with cache.engine.connect() as conn:
+            self.assertEqual('memory', conn.exec_driver_sql('PRAGMA journal_mode').scalar())
+            self.assertEqual(2, conn.exec_driver_sql('PRAGMA temp_store').scalar())  # 2 = MEMORY
+
+    def test_set_many(self):
+        db = TTLDBCache('test', ttl=100, db_path=':memory:')
+        db.set_many((k, v) for k, v in zip('abc', range(3)))
+        db.set_many([('d', 3)], created=int(time.time() - 200))
+        self.assertEqual({'a': 0, 'b': 1, 'c': 2}, dict(db.items()))
+        self.assertNotIn('d', db)
+
+    def test_expire_amortized(self):
+        db = TTLDBCache('test', ttl=100, db_path=':memory:')
+        statements = _capture_sql(db.engine)
+        with patch.object(db, '_expire', wraps=db._expire) as expire_mock:
+            db['a'] = 1
+            self.assertEqual(1, db['a'])
+            self.assertIn('a', db)
+            self.assertEqual(1, expire_mock.call_count)
+            db._last_expire -= 10
+            self.assertEqual(1, len(db))
+            self.assertEqual(2, expire_mock.call_count)
+        # The DELETE should be executed on the same connection / in the same transaction as the triggering operation
+        self.assertEqual(['DELETE', 'INSERT'], [stmt.split()[0] for stmt in statements[:2]])
+        self.assertEqual(['DELETE', 'SELECT'], [stmt.split()[0] for stmt in statements[-2:]])
+
+    def test_expire_interval(self):
+        db = TTLDBCache('test', ttl=100, expire_interval=5, db_path=':memory:')
+        self.assertEqual(5, db._expire_interval)
+        self.assertEqual(10, TTLDBCache('test', ttl=100, db_path=':memory:')._expire_interval)
+        db.expire()
+        with patch.object(db, '_expire', wraps=db._expire) as expire_mock:
+            db['a'] = 1
+            self.assertEqual(0, expire_mock.call_count)  # The explicit expire call reset the interval
+
+    def test_expire_incremental_vacuum(self):
+        with TemporaryDirectory() as tmp_dir:
+            db = TTLDBCache('test', ttl=100, db_path=Path(tmp_dir).joinpath('test.db'))
+            db.set_many(((i, 'x' * 1000) for i in range(2000)), created=int(time.time() - 200))
+            with patch.object(db, '_incremental_vacuum', wraps=db._incremental_vacuum) as vacuum_mock:
+                db.expire()
+                vacuum_mock.assert_called_once_with()
+            with db._connection() as conn:
+                self.assertLess(conn.exec_driver_sql('PRAGMA freelist_count').scalar(), 100)
+            db.engine.dispose()
+
+    def test_periodic_optimize(self):
+        cache = DBCache('test', db_path=':memory:')
+        statements = _capture_sql(cache.engine)
+        cache['a'] = 1
+        self.assertNotIn('PRAGMA optimize', statements)
+        with patch('db_cache.caches._OPTIMIZE_INTERVAL', 0):
+            cache['a'] = 2
+        self.assertIn('PRAGMA optimize', statements)
+        self.assertFalse(cache._get_conn().in_transaction())
+
+        def fail_optimize(conn, cursor, statement, *args):
+            if statement == 'PRAGMA optimize':
+                raise OperationalError(statement, (), Exception('database is locked'))
+
+        event.listen(cache.engine, 'before_cursor_execute', fail_optimize)
+        with patch('db_cache.caches._OPTIMIZE_INTERVAL', 0), self.assertLogs('db_cache.caches', 'DEBUG'):
+            cache['a'] = 3  # The failure is logged instead of being raised after the write was committed
+        self.assertFalse(cache._get_conn().in_transaction())
+        self.assertEqual(3, cache['a'])
+
     def test_cache_key(self):
         ck = _CacheKey.simple_noself(None, 'foo', 'bar')
         self.assertEqual(('foo', 'bar'), ck._vals)
@@ -116,6 +641,61 @@ class TTLDBCacheTest(TestCase):
         self.assertEqual(ck, ck)
         self.assertNotEqual(ck, None)
 
+    def test_cache_key_kwargs(self):
+        self.assertEqual(('a', _CacheKey, 'x', 1), _CacheKey._to_tuple('a', x=1))
+        self.assertEqual(('a', _CacheKey, 'x', 1, 'y', 2), _CacheKey._to_tuple('a', y=2, x=1))
+        self.assertEqual(_CacheKey.simple_noself(None, x=1, y=2), _CacheKey.simple_noself(None, y=2, x=1))
+        self.assertNotEqual(_CacheKey.simple_noself(None, x=1), _CacheKey.simple_noself(None, 'x', 1))
+
+    def test_cache_key_interned(self):
+        short, long = ''.join(['fo', 'o']), ''.join(['x' * 40, 'y' * 40])
+        ck = _CacheKey.simple_noself(None, short, long, 1)
+        self.assertIs(ck._vals[0], _CacheKey.simple_noself(None, 'foo')._vals[0])
+        self.assertIs(long, ck._vals[1])
+        self.assertEqual(ck, _CacheKey.simple_noself(None, 'foo', 'x' * 40 + 'y' * 40, 1))
+
+    def test_cache_key_pickle(self):
+        ck = _CacheKey.simple_noself(None, 'foo', bar=1)
+        self.assertEqual(ck, pickle.loads(pickle.dumps(ck)))
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_cache_key_msgpack(self):
+        ck = _CacheKey.msgpack_noself(None, [1, 2], b=2, a={'x': [3]})
+        self.assertEqual(ck, _CacheKey.from_any([1, 2], a={'x': [3]}, b=2))
+        self.assertEqual(hash(ck), hash(_CacheKey.from_any([1, 2], a={'x': [3]}, b=2)))
+        self.assertNotEqual(ck, _CacheKey.from_any([1, 2], a={'x': [4]}, b=2))
+        self.assertEqual(ck, pickle.loads(pickle.dumps(ck)))
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_cache_key_msgpack_canonical(self):
+        self.assertEqual(_CacheKey.from_any(x={'a': 1, 'b': 2}), _CacheKey.from_any(x={'b': 2, 'a': 1}))
+        self.assertEqual(_CacheKey.from_any([{1: 'a', 'b': [2]}]), _CacheKey.from_any([{'b': [2], 1: 'a'}]))
+        self.assertNotEqual(_CacheKey.from_any((1, 2)), _CacheKey.from_any([1, 2]))
+        self.assertNotEqual(_CacheKey.from_any([(1, 2)]), _CacheKey.from_any([[1, 2]]))
+        self.assertEqual(_CacheKey.from_any({(1, 2): 'a'}), _CacheKey.from_any({(1, 2): 'a'}))
+
+    def test_key_mode(self):
+        class MsgpackCache(DBCache):
+            key_mode = 'msgpack'
+
+        self.assertEqual(_CacheKey.msgpack_noself, MsgpackCache._get_default_key_func())
+
+    def test_cache_key_msgpack_missing(self):
+        with patch('db_cache.caches.msgpack', None), self.assertRaises(RuntimeError):
+            _CacheKey.from_any([1])
+
+
+class ScopedSessionTest(TestCase):
+    def test_session_reused(self):
+        cache = DBCache('test', db_path=':memory:')
+        with cache.db_session as session:
+            first = session()
+        with cache.db_session as session:
+            self.assertIs(first, session())
+        cache.db_session.remove()
+        with cache.db_session as session:
+            self.assertIsNot(first, session())
+
 
 if __name__ == '__main__':
     try: